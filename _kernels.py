@@ -0,0 +1,56 @@
+import math
+import numpy as np
+from scipy.special import erfc
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def gray_radtan(dlam, zeta):
+        '''
+        Radial-tangential macroturbulence profile (Gray 1978) with equal
+            radial and tangential components, sampled at the wavelength
+            offsets dlam for a width zeta (both in angstroms).  Unnormalized.
+        '''
+        kernel = np.empty_like(dlam)
+        for i in prange(dlam.shape[0]):
+            u = abs(dlam[i]) / zeta
+            kernel[i] = (math.exp(-u * u)
+                         - math.sqrt(math.pi) * u * math.erfc(u))
+        return kernel
+
+    @njit(parallel=True, cache=True)
+    def gray_rot(dlam, width, epsilon):
+        '''
+        Rotational broadening profile (Gray) with linear limb darkening
+            coefficient epsilon, sampled at the wavelength offsets dlam for
+            a width of lambda * vsini / c (both in angstroms).  Unnormalized.
+        '''
+        kernel = np.empty_like(dlam)
+        for i in prange(dlam.shape[0]):
+            u2 = max(1. - (dlam[i] / width)**2, 0.)
+            kernel[i] = (2. * (1. - epsilon) * math.sqrt(u2)
+                         + 0.5 * math.pi * epsilon * u2)
+        return kernel
+else:
+    def gray_radtan(dlam, zeta):
+        '''
+        Radial-tangential macroturbulence profile (Gray 1978) with equal
+            radial and tangential components, sampled at the wavelength
+            offsets dlam for a width zeta (both in angstroms).  Unnormalized.
+        '''
+        u = np.abs(dlam) / zeta
+        return np.exp(-u**2) - np.sqrt(np.pi) * u * erfc(u)
+
+    def gray_rot(dlam, width, epsilon):
+        '''
+        Rotational broadening profile (Gray) with linear limb darkening
+            coefficient epsilon, sampled at the wavelength offsets dlam for
+            a width of lambda * vsini / c (both in angstroms).  Unnormalized.
+        '''
+        u2 = np.clip(1. - (dlam / width)**2, 0., None)
+        return 2. * (1. - epsilon) * np.sqrt(u2) + 0.5 * np.pi * epsilon * u2
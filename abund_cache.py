@@ -0,0 +1,31 @@
+from functools import lru_cache
+from types import MappingProxyType
+import abund_utils as au
+
+
+@lru_cache(maxsize=8)
+def solar_abund(reference):
+    '''
+    Cached version of abund_utils.solar_abund, shared by the abundance and
+        Turbospectrum modules so each solar reference is only read once.
+
+    reference : string, name of the solar abundance reference
+
+    returns:
+    solar_abund : read-only dictionary of element symbols and log epsilon
+        abundances
+    '''
+    return MappingProxyType(au.solar_abund(reference=reference))
+
+
+@lru_cache(maxsize=128)
+def atomic_sym_to_num(element):
+    '''
+    Cached version of abund_utils.atomic_sym_to_num.
+
+    element : string, element symbol
+
+    returns:
+    atomic_num : integer, the atomic number of the element
+    '''
+    return au.atomic_sym_to_num(element)
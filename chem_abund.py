@@ -1,5 +1,25 @@
+import sys
 import numpy as np
-import abund_utils as au
+from turbospec_wrapper.abund_cache import solar_abund
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _batch_h_to_ref(matrix, ref_col):
+        out = np.empty_like(matrix)
+        for i in prange(matrix.shape[0]):
+            ref_h = matrix[i, ref_col]
+            for j in range(matrix.shape[1]):
+                out[i, j] = matrix[i, j] - ref_h
+        return out
+else:
+    def _batch_h_to_ref(matrix, ref_col):
+        return matrix - matrix[:, ref_col:ref_col + 1]
 
 
 class ChemAbund:
@@ -30,66 +50,72 @@ class ChemAbund:
         self.references = set()
         self.solarref = 'None'
 
-        if reference.lower() in ['logeps', 'h']:
-            self._set_data(abundances, reference.lower())
+        ref = reference.lower()
+        if ref in ('logeps', 'h'):
+            self._set_data(abundances, ref)
         elif reference not in abundances:
             raise IndexError(
                 f'{reference} was given as the reference but is not in the provided abundances.')
         else:
-            self._set_data(abundances, reference.lower())
-
-        if reference.lower() != 'logeps' and reference.lower() != 'h':
+            self._set_data(abundances, ref)
             self._ref_to_h(reference)
 
         if solar_reference is not None:
             self.set_solarref(solar_reference)
 
-        if 'Fe' in self.elements and 'fe' not in self.references:
+        if 'Fe' in self._elements_set and 'fe' not in self.references:
             self._h_to_ref('Fe')
 
     def _set_data(self, abundances, reference):
-        for element, values in abundances.items():
-            if element.lower() == reference:
-                setattr(self, f'{element.lower()}_h', values)
-            else:
-                setattr(self, f'{element.lower()}_{reference.lower()}', values)
-        self.elements = abundances.keys()
-        self.references.add(reference.lower())
+        self.elements = tuple(abundances.keys())
+        self._elements_set = frozenset(self.elements)
+        self._elem_index = {element: i for i,
+                            element in enumerate(self.elements)}
+        self._elem_lower = {element: sys.intern(element.lower())
+                            for element in self.elements}
+        self._data = {reference: np.array(
+            np.broadcast_arrays(*abundances.values()), dtype=float)}
+        self.references.add(reference)
+
+    def _solar_vector(self, solar_dict, ndim):
+        solar = np.array([solar_dict[element] for element in self.elements])
+        return solar.reshape((-1,) + (1,) * (ndim - 1))
 
     def _ref_to_h(self, reference):
-        for element in self.elements:
-            if element != reference:
-                x_ref = getattr(self, f'{element.lower()}_{reference.lower()}')
-                ref_h = getattr(self, f'{reference.lower()}_h')
-                setattr(self, f'{element.lower()}_h', x_ref + ref_h)
+        i = self._elem_index[reference]
+        x_ref = self._data[self._elem_lower[reference]]
+        ref_h = x_ref[i].copy()
+        x_h = x_ref + ref_h
+        x_h[i] = ref_h
+        x_ref[i] = 0.0
+        self._data['h'] = x_h
         self.references.add('h')
 
     def _h_to_ref(self, reference):
-        for element in self.elements:
-            if element != reference:
-                x_h = getattr(self, f'{element.lower()}_h')
-                ref_h = getattr(self, f'{reference.lower()}_h')
-                setattr(
-                    self, f'{element.lower()}_{reference.lower()}', x_h - ref_h)
-        self.references.add(reference.lower())
+        ref = self._elem_lower[reference]
+        x_h = self._data['h']
+        ref_h = x_h[self._elem_index[reference]]
+        if np.any(ref_h):
+            self._data[ref] = x_h - ref_h
+        else:
+            # [X/ref] is [X/H] when [ref/H] is zero, so share the array
+            self._data[ref] = x_h
+        self.references.add(ref)
 
     def _logeps_to_h(self, solar_dict):
-        for element in self.elements:
-            x_logeps = getattr(self, f'{element.lower()}_logeps')
-            x_solar = solar_dict[element]
-            setattr(self, f'{element.lower()}_h', x_logeps - x_solar)
+        x_logeps = self._data['logeps']
+        self._data['h'] = x_logeps - \
+            self._solar_vector(solar_dict, x_logeps.ndim)
         self.references.add('h')
 
     def _h_to_logeps(self, solar_dict):
-        for element in self.elements:
-            x_h = getattr(self, f'{element.lower()}_h')
-            x_solar = solar_dict[element]
-            setattr(self, f'{element.lower()}_logeps', x_h + x_solar)
+        x_h = self._data['h']
+        self._data['logeps'] = x_h + self._solar_vector(solar_dict, x_h.ndim)
         self.references.add('logeps')
 
     def set_solarref(self, solar_reference):
         if solar_reference is not None:
-            solar_dict = au.solar_abund(reference=solar_reference)
+            solar_dict = solar_abund(solar_reference)
 
         if 'logeps' in self.references:
             self._logeps_to_h(solar_dict)
@@ -99,7 +125,7 @@ class ChemAbund:
                     runlist += [ref]
             for ref in runlist:
                 self._h_to_ref(ref.title())
-            if 'Fe' in self.elements and 'fe' not in self.references:
+            if 'Fe' in self._elements_set and 'fe' not in self.references:
                 self._h_to_ref('Fe')
         elif 'h' in self.references:
             self._h_to_logeps(solar_dict)
@@ -113,16 +139,32 @@ class ChemAbund:
             print(
                 f'x_{reference} abundances not calculated.  Please set a solar reference first.')
 
+    def batch_h_to_ref(self, stack, reference):
+        '''
+        Converts [X/H] abundances for many stars at once to be relative to
+            the given reference element.  Uses numba when it is available.
+
+        stack : 2D array of [X/H] abundances with shape
+            (n_stars, n_elements), with columns in the order of self.elements
+        reference : string, element symbol of the reference element
+
+        returns:
+        2D array of [X/reference] abundances with the same shape as stack
+        '''
+        stack = np.ascontiguousarray(stack, dtype=float)
+        return _batch_h_to_ref(stack, self._elem_index[reference])
+
     def format_abundances(self, reference):
         if reference.lower() not in self.references:
             print(f'{reference} has not been calculated for these abundances please set a solar reference or calculate relative to this reference first.')
         else:
             output = {}
-            for element in self.elements:
+            x_h = self._data['h']
+            x_ref = self._data[reference.lower()]
+            for element, i in self._elem_index.items():
                 if element == reference:
-                    output[element] = getattr(self, f'{element.lower()}_h')
+                    output[element] = x_h[i]
                 else:
-                    output[element] = getattr(
-                        self, f'{element.lower()}_{reference.lower()}')
+                    output[element] = x_ref[i]
 
             return output
@@ -1,6 +1,10 @@
 import os
 import subprocess
-from abund_utils import atomic_sym_to_num, solar_abund, ALPHAS
+import sys
+import tempfile
+from pathlib import Path
+from abund_utils import ALPHAS
+from turbospec_wrapper.abund_cache import atomic_sym_to_num, solar_abund
 
 WAVE_KEYS = ['lambda_range', 'delta_lambda'],
 ABUND_KEYS = ['metals', 'alphas', 'helium', 'rprocess', 'sprocess',
@@ -9,6 +13,62 @@ BABSMA_KEYS = ['model', 'vmicro', 'marcs_file_flag']
 BSYN_KEYS = ['sph_flag', 'linelists', 'isotopes']
 
 
+_ABUND_TEMPLATE = (
+    "'METALLICITY:'    '{metals:.3f}'\n"
+    "'ALPHA/Fe   :'    '{alphas:.3f}'\n"
+    "'HELIUM     :'    '{helium:.3f}'\n"
+    "'R-PROCESS  :'    '{rprocess:.3f}'\n"
+    "'S-PROCESS  :'    '{sprocess:.3f}'\n"
+    "'INDIVIDUAL ABUNDANCES:'  '{n_abund}'\n"
+    "{abundances}")
+
+_WAVE_TEMPLATE = (
+    "'LAMBDA_MIN:'  '{lambda_min}'\n"
+    "'LAMBDA_MAX:'  '{lambda_max}'\n"
+    "'LAMBDA_STEP:' '{delta_lambda}'\n")
+
+_BABSMA_TEMPLATE = (
+    _WAVE_TEMPLATE
+    + "'MODELINPUT:' '{modelpath}'\n"
+    "'MARCS-FILE:' '{marcs_string}'\n"
+    "'MODELOPAC:' '{opac_filename}'\n"
+    + _ABUND_TEMPLATE
+    + "'XIFIX:' 'T'\n"
+    "{vmicro:.3f}\n")
+
+# Shared by bsyn and eqwidt, which differ only in ABFIND and in eqwidt
+# listing the result file twice.
+_BSYN_TEMPLATE = (
+    _WAVE_TEMPLATE
+    + "'INTENSITY/FLUX:' 'Flux'\n"
+    "'COS(THETA)    :' '1.00'\n"
+    "'ABFIND        :' '{abfind}'\n"
+    "'MODELOPAC:' '{opac_filename}'\n"
+    "{resultfile}"
+    + _ABUND_TEMPLATE
+    + "'ISOTOPES:'  '{n_iso}'\n"
+    "{isotopes}"
+    "'NFILES:'  '{n_files}'\n"
+    "{linelists}"
+    "'SPHERICAL:'  '{sph_flag}'\n"
+    "  30\n"
+    "  300.00\n"
+    "  15\n"
+    "  1.30\n")
+
+
+_H_HE = frozenset({'H', 'He'})
+_ALPHAS_SET = frozenset(ALPHAS)
+
+def _linelist_path(linelist):
+    # Linelists that exist relative to the current directory are made
+    # absolute; anything else (e.g., 'DATA/Hlinedata') is left to resolve
+    # inside the run directory, which links to the Turbospectrum DATA folder.
+    if os.path.exists(linelist):
+        return os.path.abspath(linelist)
+    return linelist
+
+
 class TurbospecManager:
     '''
     A class to help format the inputs and run Turbospectrum to create synthetic
@@ -27,26 +87,34 @@ class TurbospecManager:
             should read through the below functions to see what settings can
             be set).
 
-        inpath : string, the path to the input models
-        outpath : string, the path to place output synthetic spectra
+        inpath : string or Path, the path to the input models
+        outpath : string or Path, the path to place output synthetic spectra
         turbopath : string, the path to Turbospectrum
         turbo_exec : string, folder location of Turbospectrum executables
         auto: boolean, True will run Turbospectrum automatically, False allows
             for manual setting and running
         '''
 
-        self.inpath = inpath
+        self.inpath = Path(inpath)
         if outpath is None:
-            self.outpath = inpath
+            self.outpath = self.inpath
         else:
-            self.outpath = outpath
+            self.outpath = Path(outpath)
         self.turbopath = turbopath
-        self.turbo_exec = f'{turbopath}/{turbo_exec}'
+        self.turbo_exec = os.path.join(turbopath, turbo_exec)
+        self._data_src = os.path.abspath(os.path.join(turbopath, 'DATA'))
+        self._babsma_lu = os.path.abspath(
+            os.path.join(self.turbo_exec, 'babsma_lu'))
+        self._bsyn_lu = os.path.abspath(
+            os.path.join(self.turbo_exec, 'bsyn_lu'))
+        self._eqwidt_lu = os.path.abspath(
+            os.path.join(self.turbo_exec, 'eqwidt_lu'))
         self._wave_flag = False
         self._abund_flag = False
         self._babsma_flag = False
         self._syn_flag = False
         self._eqwidt_flag = False
+        self._last_model = None
 
         if auto:
             wave_kwargs = {key: value for key,
@@ -80,11 +148,13 @@ class TurbospecManager:
         self.delta_lambda = delta_lambda
         self.lambda_min = lambda_range[0] - delta_lambda
         self.lambda_max = lambda_range[1] + delta_lambda
+        self._lmin_s = f'{self.lambda_min:.3f}'
+        self._lmax_s = f'{self.lambda_max:.3f}'
         self._wave_flag = True
 
     def set_abund(self, metals=0.0, alphas=0.0, helium=0.0, rprocess=0.0,
                   sprocess=0.0, abundances=None, solar_reference='Asplund2009',
-                  exclude=['H', 'He']):
+                  exclude=_H_HE):
         '''
         This method will take the input abundance tags and compute and format
             individual abundances for input into Turbospectrum.  If individual
@@ -113,7 +183,7 @@ class TurbospecManager:
             the default solar_references that are in abund_utils or they can
             input a dictionary of element symbol and log epsilon solar
             abundance pairs e.g., {'C' : 8.66,}.
-        exclude : list, elements to not input their abundances
+        exclude : list or set, elements to not input their abundances
             in the synthesis
         '''
         self.metals = metals
@@ -123,23 +193,22 @@ class TurbospecManager:
         self.sprocess = sprocess
 
         if isinstance(solar_reference, str):
-            solar_abu = solar_abund(reference=solar_reference)
+            solar_abu = solar_abund(solar_reference)
         elif isinstance(solar_reference, dict):
             solar_abu = solar_reference
 
-        abundance_dict = {elem: abund + metals for elem,
-                          abund in solar_abu.items() if elem not in ['H', 'He']}
+        exclude = frozenset(exclude)
 
-        for elem in ALPHAS:
-            if elem in abundance_dict:
-                abundance_dict[elem] += alphas
+        self.abundances = {
+            atomic_sym_to_num(elem): abund + metals + (
+                alphas if elem in _ALPHAS_SET else 0.0)
+            for elem, abund in solar_abu.items()
+            if elem not in _H_HE and elem not in exclude}
 
         if abundances is not None:
             for elem, abund in abundances.items():
-                abundance_dict[elem] = abund
-
-        self.abundances = {atomic_sym_to_num(elem): abund for elem,
-                           abund in abundance_dict.items() if elem not in exclude}
+                if elem not in exclude:
+                    self.abundances[atomic_sym_to_num(elem)] = abund
 
         self._abund_flag = True
 
@@ -163,14 +232,19 @@ class TurbospecManager:
             as an input for running bsyn
         '''
         if not self._wave_flag:
-            print('Please set the wavelength range first.')
+            raise RuntimeError('Please set the wavelength range first.')
         if not self._abund_flag:
-            print('Abundances were not set.')
+            raise RuntimeError('Abundances were not set.')
 
-        if not os.path.isfile(f'{self.inpath}/{model}'):
-            print(f'The model "{self.inpath}/{model}" does not exist')
+        if self._last_model is not None and self._last_model[0] == model:
+            modelpath = self._last_model[1]
         else:
-            modelpath = f'{self.inpath}/{model}'
+            modelpath = self.inpath / model
+            if not modelpath.is_file():
+                raise FileNotFoundError(
+                    f'The model "{modelpath}" does not exist')
+            modelpath = os.path.abspath(modelpath)
+            self._last_model = (model, modelpath)
 
         if marcs_file_flag:
             marcs_string = '.true.'
@@ -178,7 +252,7 @@ class TurbospecManager:
             marcs_string = '.false.'
 
         self.model = model
-        self.opac_filename = f'{self.inpath}/{model}_opac'
+        self.opac_filename = str(self.inpath / f'{model}_opac')
 
         babsma_dict = {
             'modelpath': modelpath,
@@ -188,28 +262,8 @@ class TurbospecManager:
 
         eof_list = self._write_parameters('babsma', **babsma_dict)
 
-        for line in eof_list:
-            print(line, end='')
-        if verbose:
-            stdout = None
-            stderr = None
-        else:
-            stdout = open('/dev/null', 'w')
-            stderr = subprocess.STDOUT
-
-        print(os.path.exists('DATA'))
-        if not os.path.exists('DATA'):
-            os.symlink(f'{self.turbopath}/DATA', 'DATA')
+        self._run_exec(self._babsma_lu, eof_list, verbose=verbose)
 
-        p = subprocess.Popen([f'{self.turbo_exec}/babsma_lu'],
-                             stdin=subprocess.PIPE,
-                             stdout=stdout,
-                             stderr=stderr)
-        for line in eof_list:
-            p.stdin.write(line.encode('utf-8'))
-        stdout, stderr = p.communicate()
-
-        # os.remove('DATA')
         self._babsma_flag = True
 
         return self.opac_filename
@@ -241,13 +295,13 @@ class TurbospecManager:
         if opac_filename is not None:
             self.opac_filename = opac_filename
         elif not self._babsma_flag:
-            print('Please run babsma first to produce and opacity file,'
-                  'otherwise enter in an opacity file.')
+            raise RuntimeError('Please run babsma first to produce an opacity '
+                               'file, otherwise enter in an opacity file.')
 
         if result_filename is None:
-            result_filename = f'{self.model}_{self.lambda_min}_{self.lambda_max}.spec'
+            result_filename = f'{self.model}_{self._lmin_s}_{self._lmax_s}.spec'
 
-        synthpath = f'{self.outpath}/{result_filename}'
+        synthpath = os.path.abspath(self.outpath / result_filename)
 
         if sph_flag:
             sph_flag_string = 'T'
@@ -263,27 +317,8 @@ class TurbospecManager:
 
         eof_list = self._write_parameters('bsyn', **bsyn_dict)
 
-        for line in eof_list:
-            print(line, end='')
-        if verbose:
-            stdout = None
-            stderr = None
-        else:
-            stdout = open('/dev/null', 'w')
-            stderr = subprocess.STDOUT
-
-        if not os.path.exists('DATA'):
-            os.symlink(f'{self.turbopath}/DATA', 'DATA')
-
-        p = subprocess.Popen([f'{self.turbo_exec}/bsyn_lu'],
-                             stdin=subprocess.PIPE,
-                             stdout=stdout,
-                             stderr=stderr)
-        for line in eof_list:
-            p.stdin.write(line.encode('utf-8'))
-        stdout, stderr = p.communicate()
+        self._run_exec(self._bsyn_lu, eof_list, verbose=verbose)
 
-        # os.remove('DATA')
         self._bsyn_flag = True
 
         return result_filename
@@ -315,13 +350,13 @@ class TurbospecManager:
         if opac_filename is not None:
             self.opac_filename = opac_filename
         elif not self._babsma_flag:
-            print('Please run babsma first to produce and opacity file,'
-                  'otherwise enter in an opacity file.')
+            raise RuntimeError('Please run babsma first to produce an opacity '
+                               'file, otherwise enter in an opacity file.')
 
         if result_filename is None:
-            result_filename = f'{self.model}_{self.lambda_min}_{self.lambda_max}.findabu'
+            result_filename = f'{self.model}_{self._lmin_s}_{self._lmax_s}.findabu'
 
-        synthpath = f'{self.outpath}/{result_filename}'
+        synthpath = os.path.abspath(self.outpath / result_filename)
 
         if sph_flag:
             sph_flag_string = 'T'
@@ -337,83 +372,85 @@ class TurbospecManager:
 
         eof_list = self._write_parameters('eqwidt', **eqwidt_dict)
 
-        for line in eof_list:
-            print(line, end='')
+        self._run_exec(self._eqwidt_lu, eof_list, verbose=verbose)
+
+        self._eqwidt_flag = True
+
+        return result_filename
+
+    def _run_exec(self, executable, eof_list, verbose=False):
+        '''
+        Runs a Turbospectrum executable with the lines in eof_list as its
+            input.  Each run happens in its own temporary working directory
+            that links to the Turbospectrum DATA folder, so separate runs
+            (e.g., in parallel processes) do not share any files.
+
+        executable : string, path to the executable
+        eof_list : list, lines to pass to the executable
+        verbose : boolean, set to True to see the log from the executable
+        '''
+        payload = ''.join(eof_list)
         if verbose:
+            sys.stdout.write(payload)
             stdout = None
             stderr = None
         else:
-            stdout = open('/dev/null', 'w')
+            stdout = subprocess.DEVNULL
             stderr = subprocess.STDOUT
 
-        if not os.path.exists('DATA'):
-            os.symlink(f'{self.turbopath}/DATA', 'DATA')
-
-        p = subprocess.Popen([f'{self.turbo_exec}/eqwidt_lu'],
-                             stdin=subprocess.PIPE,
-                             stdout=stdout,
-                             stderr=stderr)
-        for line in eof_list:
-            p.stdin.write(line.encode('utf-8'))
-        stdout, stderr = p.communicate()
-
-        # os.remove('DATA')
-        self._eqwidt_flag = True
-
-        return result_filename
+        with tempfile.TemporaryDirectory() as workdir:
+            os.symlink(self._data_src, os.path.join(workdir, 'DATA'))
+            subprocess.run(
+                [executable],
+                input=payload.encode('utf-8'),
+                stdout=stdout,
+                stderr=stderr,
+                cwd=workdir)
 
     def _write_parameters(self, version, **kwargs):
         '''
-        Creates a list of lines to feed into babsma and bsyn.
+        Creates the input to feed into babsma, bsyn or eqwidt by filling in
+            the module level templates, returned as a list holding the
+            formatted block.
 
-        version : string, either babsma or bsyn
-        kwargs : dictionary of necessary inputs for babsma or bsyn
+        version : string, either babsma, bsyn or eqwidt
+        kwargs : dictionary of necessary inputs for babsma, bsyn or eqwidt
         '''
 
-        eof_list = []
+        fields = {
+            'lambda_min': self._lmin_s,
+            'lambda_max': self._lmax_s,
+            'delta_lambda': self.delta_lambda,
+            'opac_filename': os.path.abspath(self.opac_filename),
+            'metals': self.metals,
+            'alphas': self.alphas,
+            'helium': self.helium,
+            'rprocess': self.rprocess,
+            'sprocess': self.sprocess,
+            'n_abund': len(self.abundances),
+            'abundances': ''.join('%s  %.3f\n' % item
+                                  for item in self.abundances.items()),
+        }
 
-        eof_list += [f"'LAMBDA_MIN:'  '{self.lambda_min:.3f}'\n"]
-        eof_list += [f"'LAMBDA_MAX:'  '{self.lambda_max:.3f}'\n"]
-        eof_list += [f"'LAMBDA_STEP:' '{self.delta_lambda}'\n"]
         if version == 'babsma':
-            eof_list += [f"'MODELINPUT:' '{kwargs['modelpath']}'\n"]
-            eof_list += [f"'MARCS-FILE:' '{kwargs['marcs_string']}'\n"]
-        if version == 'bsyn':
-            eof_list += ["'INTENSITY/FLUX:' 'Flux'\n"]
-            eof_list += ["'COS(THETA)    :' '1.00'\n"]
-            eof_list += ["'ABFIND        :' '.false.'\n"]
-        if version == 'eqwidt':
-            eof_list += ["'INTENSITY/FLUX:' 'Flux'\n"]
-            eof_list += ["'COS(THETA)    :' '1.00'\n"]
-            eof_list += ["'ABFIND        :' '.true.'\n"]
-        eof_list += [f"'MODELOPAC:' '{self.opac_filename}'\n"]
-        if (version == 'bsyn') or (version == 'eqwidt'):
-            eof_list += [f"'RESULTFILE :' '{kwargs['synthpath']}'\n"]
+            return [_BABSMA_TEMPLATE.format(**fields, **kwargs)]
+
+        resultfile = f"'RESULTFILE :' '{kwargs['synthpath']}'\n"
         if version == 'eqwidt':
-            eof_list += [f"'RESULTFILE :' '{kwargs['synthpath']}'\n"]
-        eof_list += [f"'METALLICITY:'    '{self.metals:.3f}'\n"]
-        eof_list += [f"'ALPHA/Fe   :'    '{self.alphas:.3f}'\n"]
-        eof_list += [f"'HELIUM     :'    '{self.helium:.3f}'\n"]
-        eof_list += [f"'R-PROCESS  :'    '{self.rprocess:.3f}'\n"]
-        eof_list += [f"'S-PROCESS  :'    '{self.sprocess:.3f}'\n"]
-        eof_list += [f"'INDIVIDUAL ABUNDANCES:'  '{len(self.abundances)}'\n"]
-        for elem, abund in self.abundances.items():
-            eof_list += [f"{elem}  {abund:.3f}\n"]
-        if (version == 'bsyn') or (version == 'eqwidt'):
-            eof_list += [f"'ISOTOPES:'  '{len(kwargs['isotopes'])}'\n"]
-            for isotope, fraction in kwargs['isotopes'].items():
-                eof_list += [f"{isotope}  {fraction:.6f}\n"]
-        if version == 'babsma':
-            eof_list += ["'XIFIX:' 'T'\n"]
-            eof_list += [f"{kwargs['vmicro']:.3f}\n"]
-        if (version == 'bsyn') or (version == 'eqwidt'):
-            eof_list += [f"'NFILES:'  '{len(kwargs['linelists'])}'\n"]
-            for linelist in kwargs['linelists']:
-                eof_list += [f"{linelist}\n"]
-            eof_list += [f"'SPHERICAL:'  '{kwargs['sph_flag']}'\n"]
-            eof_list += ["  30\n"]
-            eof_list += ["  300.00\n"]
-            eof_list += ["  15\n"]
-            eof_list += ["  1.30\n"]
-
-        return eof_list
+            abfind = '.true.'
+            resultfile *= 2
+        else:
+            abfind = '.false.'
+
+        fields.update(
+            abfind=abfind,
+            resultfile=resultfile,
+            n_iso=len(kwargs['isotopes']),
+            isotopes=''.join('%s  %.6f\n' % item
+                             for item in kwargs['isotopes'].items()),
+            n_files=len(kwargs['linelists']),
+            linelists=''.join(f"{_linelist_path(linelist)}\n"
+                              for linelist in kwargs['linelists']),
+            sph_flag=kwargs['sph_flag'])
+
+        return [_BSYN_TEMPLATE.format(**fields)]
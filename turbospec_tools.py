@@ -1,7 +1,19 @@
 import os
 import subprocess
+import sys
+from pathlib import Path
 import numpy as np
+from scipy.signal import oaconvolve
 from spec_tools import Spectrum
+from turbospec_wrapper._kernels import gray_radtan, gray_rot
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+C_KMS = 299792.458
+ROT_EPSILON = 0.6
 
 
 class SpectrumTS(Spectrum):
@@ -11,13 +23,187 @@ class SpectrumTS(Spectrum):
         else:
             usecols = (0, 2)
 
-        data = np.genfromtxt(filepath, dtype=None, encoding=None,
-                             usecols=usecols)
+        data = np.loadtxt(filepath, usecols=usecols, dtype=np.float64)
         wave = data[:, 0]
         flux = data[:, 1]
         super().__init__(wave, flux)
 
 
+def read_synth(filepath):
+    '''
+    Reads a Turbospectrum synthetic spectrum into a 2D array with columns
+        of wavelength, normalized flux and (if present) unnormalized flux.
+        Files ending in .npy (see TurboSynth's binary_output) are memory
+        mapped read-only rather than parsed.  Text files are parsed with the
+        pandas C reader when pandas is installed.
+    '''
+    if str(filepath).endswith('.npy'):
+        return np.load(filepath, mmap_mode='r')
+    if pd is not None:
+        return pd.read_csv(filepath, sep=r'\s+', header=None,
+                           dtype=np.float64, engine='c').to_numpy()
+    return np.loadtxt(filepath, ndmin=2)
+
+
+def broadening_kernel(profile, step, width):
+    '''
+    Samples one of the faltbon broadening profiles on a uniform wavelength
+        grid.  The radial-tangential profile assumes equal radial and
+        tangential components (Gray 1978) and the rotational profile uses a
+        linear limb darkening coefficient of ROT_EPSILON.
+
+    Inputs
+
+    profile : integer (1-4), indicates what broadening profile to use
+        (1=exp, 2=gauss, 3=rad-tan, 4=rot)
+    step : float, wavelength step of the spectrum in angstroms
+    width : float, width of the profile in angstroms, i.e., the FWHM for
+        profiles 1 and 2, zeta for profile 3 and lambda * vsini / c for
+        profile 4
+
+    Output
+
+    kernel : array, the profile normalized to a unit sum
+    '''
+    if profile == 1:
+        scale = width / (2. * np.log(2.))
+        half_width = 8. * scale
+    elif profile == 2:
+        scale = width / (2. * np.sqrt(2. * np.log(2.)))
+        half_width = 4. * scale
+    elif profile == 3:
+        half_width = 4. * width
+    elif profile == 4:
+        half_width = width
+    else:
+        raise ValueError('profile must be one of '
+                         '1=exp, 2=gauss, 3=rad-tan, 4=rot')
+
+    n = int(half_width / step)
+    if n < 1:
+        return np.ones(1)
+    x = np.arange(-n, n + 1) * step
+
+    if profile == 1:
+        kernel = np.exp(-np.abs(x) / scale)
+    elif profile == 2:
+        kernel = np.exp(-0.5 * (x / scale)**2)
+    elif profile == 3:
+        kernel = gray_radtan(x, width)
+    else:
+        kernel = gray_rot(x, width, ROT_EPSILON)
+
+    return kernel / kernel.sum()
+
+
+def convolve_spectrum(wave, flux, profile=None, fwhm=None, vel=None):
+    '''
+    Convolves a spectrum on a uniform wavelength grid with one of the
+        faltbon broadening profiles using overlap-add convolution.  The
+        spectrum is padded with its edge values so the ends are not pulled
+        towards zero.
+
+    Inputs
+
+    wave : array, uniformly spaced wavelengths in angstroms
+    flux : array, flux at each wavelength, convolved in float32
+    profile : integer (1-4), indicates what broadening profile to use
+        (1=exp, 2=gauss, 3=rad-tan, 4=rot)
+    fwhm : float, convolutional broadening width in miliAngstroms
+    vel : float, convolutional broadening velocity in km/s (the FWHM for
+        profiles 1 and 2, zeta for 3 and vsini for 4), converted to a width
+        at the central wavelength
+
+    Output
+
+    flux : float32 array, the convolved flux
+    '''
+    if profile is None:
+        raise TypeError('You must enter a value for profile'
+                        '(1=exp, 2=gauss, 3=rad-tan, 4=rot)')
+
+    if fwhm is not None:
+        width = fwhm / 1000.
+    elif vel is not None:
+        width = vel / C_KMS * 0.5 * (wave[0] + wave[-1])
+    else:
+        raise TypeError('You must enter a value for either fwhm or vel')
+
+    step = (wave[-1] - wave[0]) / (len(wave) - 1)
+    kernel = broadening_kernel(profile, step, width).astype(np.float32)
+    n = len(kernel) // 2
+    flux = np.asarray(flux).astype(np.float32, copy=False)
+
+    return oaconvolve(np.pad(flux, n, mode='edge'), kernel, mode='valid')
+
+
+def convolve_gaussian_batch(wave, flux, fwhms, max_ratio=1.2, exact=False):
+    '''
+    Approximates Gaussian convolutions of one spectrum with many FWHMs
+        using a few convolutions at knot FWHMs spaced by at most a factor
+        of max_ratio between the narrowest and broadest FWHM.  Each result
+        is the weighted sum of the convolutions at the two neighbouring
+        knots, with the weight chosen so the combined kernel has the
+        variance of the requested Gaussian.
+
+    The error grows roughly as (max_ratio - 1)**2 and is largest for
+        unresolved lines.  For lines narrower than the kernel, the maximum
+        error is about 1.3% of the line depth at max_ratio=1.2, 6% at 1.5
+        and 18% at 2.  Use exact=True to convolve every FWHM separately.
+
+    Inputs
+
+    wave : array, uniformly spaced wavelengths in angstroms
+    flux : array, flux at each wavelength
+    fwhms : list or array of floats, Gaussian FWHMs in miliAngstroms, where
+        values of zero or less return the flux unbroadened
+    max_ratio : float, largest ratio between neighbouring knot FWHMs
+    exact : boolean, True to convolve with each FWHM instead of
+        interpolating
+
+    Output
+
+    fluxes : 2D float32 array, one convolved spectrum per FWHM with shape
+        (len(fwhms), len(flux))
+    '''
+    fwhms = np.asarray(fwhms, dtype=float)
+    fluxes = np.empty((len(fwhms), len(flux)), dtype=np.float32)
+    if exact:
+        for i, fwhm in enumerate(fwhms):
+            fluxes[i] = convolve_spectrum(wave, flux, profile=2, fwhm=fwhm)
+        return fluxes
+
+    # FWHMs of zero or less leave the spectrum unchanged, as in
+    # convolve_spectrum, and cannot be used as knots
+    broadened = fwhms > 0.
+    fluxes[~broadened] = flux
+    if not broadened.any():
+        return fluxes
+    fwhms = fwhms[broadened]
+
+    fwhm_min = fwhms.min()
+    fwhm_max = fwhms.max()
+
+    n_knots = 1 + int(np.ceil(np.log(fwhm_max / fwhm_min)
+                              / np.log(max_ratio) - 1e-9))
+    knots = np.geomspace(fwhm_min, fwhm_max, n_knots)
+    convolved = np.array([convolve_spectrum(wave, flux, profile=2, fwhm=knot)
+                          for knot in knots])
+    if n_knots == 1:
+        fluxes[broadened] = convolved[0]
+        return fluxes
+
+    upper = np.clip(np.searchsorted(knots, fwhms), 1, n_knots - 1)
+    lower = upper - 1
+    weights = ((fwhms**2 - knots[lower]**2)
+               / (knots[upper]**2 - knots[lower]**2)).astype(np.float32)
+
+    narrow = convolved[lower]
+    fluxes[broadened] = narrow + weights[:, np.newaxis] * (convolved[upper]
+                                                           - narrow)
+    return fluxes
+
+
 class ConvolutionManager:
     '''
     This class runs faltbon which convolves Turbospectrum
@@ -32,6 +218,9 @@ class ConvolutionManager:
 
         Users may provide either a FWHM of the broadening profile or the
         velocity which will be converted into the correct values by faltbon.
+
+        run_inproc applies the same profiles with numpy/scipy instead of
+        running faltbon.
     '''
 
     def __init__(self, inpath='.', outpath=None, faltbon_path='.'):
@@ -40,19 +229,20 @@ class ConvolutionManager:
 
         Inputs
 
-        inpath : string, input path
-        outpath : string, output path
-        faltbon_path : string, path to faltbon
+        inpath : string or Path, input path
+        outpath : string or Path, output path
+        faltbon_path : string or Path, path to faltbon
 
         '''
 
-        self.inpath = inpath
-        self.faltbon_path = faltbon_path
+        self.inpath = Path(inpath)
+        self.faltbon_path = Path(faltbon_path)
+        self._faltbon = self.faltbon_path / 'faltbon'
 
         if outpath is None:
-            self.outpath = inpath
+            self.outpath = self.inpath
         else:
-            self.outpath = outpath
+            self.outpath = Path(outpath)
 
     def run_faltbon(self, filename, profile=None, fwhm=None, vel=None,
                     result=None, verbose=False):
@@ -91,41 +281,123 @@ class ConvolutionManager:
         if result is None:
             result = f'{filename}_{profile}_{broadening}.convol'
 
-        infilepath = f'{self.inpath}/{filename}'
-        outfilepath = f'{self.outpath}/{result}'
+        infilepath = self.inpath / filename
+        outfilepath = self.outpath / result
 
         eof_list = self._write_parameters(infilepath, outfilepath, profile,
                                           broadening)
 
-        for line in eof_list:
-            print(line, end='')
+        payload = ''.join(eof_list)
         if verbose:
+            sys.stdout.write(payload)
             stdout = None
             stderr = None
         else:
-            stdout = open('/dev/null', 'w')
+            stdout = subprocess.DEVNULL
             stderr = subprocess.STDOUT
 
-        p = subprocess.Popen([f'{self.faltbon_path}/faltbon'],
-                             stdin=subprocess.PIPE,
-                             stdout=stdout,
-                             stderr=stderr)
+        subprocess.run([self._faltbon],
+                       input=payload.encode('utf-8'),
+                       stdout=stdout,
+                       stderr=stderr)
+
+        return result
+
+    def run_inproc(self, filename, profile=None, fwhm=None, vel=None,
+                   result=None, data=None):
+        '''
+        Convolves a spectrum in python rather than with faltbon, taking the
+            same inputs as run_faltbon.  Every flux column of the input file
+            is convolved and written out alongside the wavelengths.
+
+        Inputs
+
+        filename : string, points to the turbospectrum synthetic spectrum to
+            convolve
+        profile : integer (1-4), indicates what broadening profile to use
+            (1=exp, 2=gauss, 3=rad-tan, 4=rot)
+        fwhm : float, convolutional broadening FWHM in miliAngstroms
+        vel : float, convolutional broadening velocity in km/s
+        result : string, output filename
+        data : 2D array, optional contents of filename (e.g., already read
+            with read_synth) to convolve instead of reading the file
+
+        Output
+
+        result : the resulting filename
+        '''
+
+        if fwhm is not None:
+            broadening = fwhm
+        elif vel is not None:
+            broadening = -1 * vel
+        else:
+            raise TypeError('You must enter a value for either fwhm or vel')
+
+        if result is None:
+            result = f'{filename}_{profile}_{broadening}.convol'
+
+        if data is None:
+            data = read_synth(self.inpath / filename)
+        data = np.array(data, dtype=float)
+
+        for i in range(1, data.shape[1]):
+            data[:, i] = convolve_spectrum(data[:, 0], data[:, i],
+                                           profile=profile, fwhm=fwhm,
+                                           vel=vel)
 
-        for line in eof_list:
-            p.stdin.write(line.encode('utf-8'))
-        stdout, stderr = p.communicate()
+        np.savetxt(self.outpath / result, data,
+                   fmt=['%.4f'] + ['%.6e'] * (data.shape[1] - 1))
 
         return result
 
+    def run_batch(self, filename, fwhms, normed=True, data=None,
+                  max_ratio=1.2, exact=False):
+        '''
+        Convolves a spectrum with a set of Gaussian FWHMs at once using
+            convolve_gaussian_batch, e.g., to scan over spectral resolution.
+
+        Inputs
+
+        filename : string, points to the turbospectrum synthetic spectrum to
+            convolve
+        fwhms : list or array of floats, Gaussian FWHMs in miliAngstroms
+        normed : boolean, True to convolve the normalized flux and False for
+            the unnormalized flux
+        data : 2D array, optional contents of filename (e.g., already read
+            with read_synth) to convolve instead of reading the file
+        max_ratio : float, largest ratio between neighbouring knot FWHMs
+        exact : boolean, True to convolve with each FWHM separately
+
+        Output
+
+        wave : array, the wavelengths of the spectrum
+        fluxes : 2D array, one convolved spectrum per FWHM
+        '''
+        if data is None:
+            data = read_synth(self.inpath / filename)
+
+        wave = data[:, 0]
+        if normed:
+            flux = data[:, 1]
+        elif data.shape[1] > 2:
+            flux = data[:, 2]
+        else:
+            raise ValueError(f'{filename} has no unnormalized flux column, '
+                             'use normed=True')
+
+        return wave, convolve_gaussian_batch(wave, flux, fwhms,
+                                             max_ratio=max_ratio, exact=exact)
+
     def _write_parameters(self, infilepath, outfilepath, profile, broadening):
         '''
         Writes the necessary input for faltbon into a list of lines
         '''
 
         eof_list = []
-        eof_list += [f"{infilepath}\n"]
-        eof_list += [f"{outfilepath}\n"]
-        eof_list += [f"{broadening:.3f}\n"]
-        eof_list += [f"{profile}\n"]
+        eof_list.append(f"{infilepath}\n")
+        eof_list.append(f"{outfilepath}\n")
+        eof_list.append(f"{broadening:.3f}\n")
+        eof_list.append(f"{profile}\n")
 
         return eof_list
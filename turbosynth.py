@@ -1,22 +1,61 @@
 import os
+import queue
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
 import abund_utils as au
 from atmos_wrapper.atmos_manager import AtmosManager
+from turbospec_wrapper.abund_cache import atomic_sym_to_num
 from turbospec_wrapper.turbospec_manager import TurbospecManager
-from turbospec_wrapper.turbospec_tools import ConvolutionManager
+from turbospec_wrapper.turbospec_tools import (ConvolutionManager,
+                                               convolve_spectrum, read_synth)
+
+
+def _file_stamp(filepath):
+    # modification time and size, used to check that a cached file has not
+    # been rewritten since it was cached
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
 
 
 class TurboSynth:
-    def __init__(self, path='.', turbopath='.', faltbon_loc='Utilities'):
+    _atmos_cache = OrderedDict()
+    _opac_cache = OrderedDict()
+    _cache_size = 256
+
+    def __init__(self, path='.', turbopath='.', faltbon_loc='Utilities',
+                 binary_output=False):
         '''
+        path : string or Path, working directory for the atmosphere,
+            opacity and spectrum files of this instance.  Give each
+            concurrently running instance its own path; turbopath is only
+            read from and can be shared.
+        turbopath : string or Path, the path to Turbospectrum
+        faltbon_loc : string, folder in turbopath containing faltbon
+        binary_output : boolean, True to also save each synthetic spectrum
+            as a .npy file (self.synth_npy_fname) for fast reloading
         '''
-        self.path = path
-        self.turbopath = turbopath
-        self.faltbon_path = f"{turbopath}/{faltbon_loc}"
+        self.path = Path(path)
+        self._abspath = os.path.abspath(self.path)
+        self.binary_output = binary_output
+        self.turbopath = Path(turbopath)
+        self.faltbon_path = self.turbopath / faltbon_loc
 
         self.turbodaemon = TurbospecManager(
-            inpath=path, turbopath=self.turbopath)
+            inpath=self.path, turbopath=self.turbopath)
         self.convoldaemon = ConvolutionManager(
-            inpath=path, faltbon_path=self.faltbon_path)
+            inpath=self.path, faltbon_path=self.faltbon_path)
+
+        self.atmosname = None
+        self._abund_key = None
+        self._sym_for_num = None
+        self._synth_data = None
+        self._synth_loaded = None
 
     def init_params(self, teff, logg, feh, vmicro=None, cfe=0.0, alphafe=0.0):
         '''
@@ -29,26 +68,69 @@ class TurboSynth:
         self.cfe = cfe
         self.alphafe = alphafe
 
+        # spherical radiative transfer below logg 3.5 and giant-like C12/C13
+        # below logg 3.8
+        self._sph_flag = logg < 3.5
+        self._giant = logg < 3.8
+
+    def reset(self, teff, logg, feh, vmicro=None, cfe=0.0, alphafe=0.0):
+        '''
+        Sets new stellar parameters and forgets the atmosphere and the
+            results of the previous synthesis (synth_wave, synth_flux,
+            synth_absflux and the output filenames), keeping the
+            Turbospectrum and convolution managers and the shared caches.
+            When running a grid, reuse one instance and call reset for each
+            point rather than creating a new TurboSynth; follow it with
+            init_abunds and make_atmosphere as usual.
+        '''
+        self.init_params(teff, logg, feh, vmicro=vmicro, cfe=cfe,
+                         alphafe=alphafe)
+
+        self.atmosname = None
+        self.opac_filename = None
+        self.synth_fname = None
+        self.synth_npy_fname = None
+        self.abund_fname = None
+        self.synth_wave = None
+        self.synth_flux = None
+        self.synth_absflux = None
+        self._synth_data = None
+        self._synth_loaded = None
+
     def init_abunds(self, abunds=None, solar_reference='Asplund2009'):
         '''
         Initializes the abundances for Turbospectrum and sets a default
             C12/C13 ratio (15 for giants and 90 for dwarfs) and N14/N15 ratio
-        '''
-        self.turbodaemon.set_abund(metals=self.feh, alphas=self.alphafe,
-                                   abundances=abunds,
-                                   solar_reference=solar_reference)
 
-        if self.logg < 3.8:
-            c12c13 = 15.
+        The full abundance set is only rebuilt when the metallicity, alpha
+            abundance, abunds or solar_reference change.  When fitting the
+            abundance of a few elements, call this once and then use
+            set_abund to change only those elements between syntheses.
+        '''
+        if isinstance(solar_reference, dict):
+            solar_key = frozenset(solar_reference.items())
         else:
-            c12c13 = 90.
+            solar_key = solar_reference
+        key = (self.feh, self.alphafe,
+               frozenset(abunds.items()) if abunds else None, solar_key)
+
+        if key != self._abund_key:
+            self.turbodaemon.set_abund(metals=self.feh, alphas=self.alphafe,
+                                       abundances=abunds,
+                                       solar_reference=solar_reference)
+            self._abund_key = key
+
+        c12c13 = 15. if self._giant else 90.
 
         n14n15 = 330.
 
-        self.isotopes = {6.012: iso_frac2('major', c12c13),
-                         6.013: iso_frac2('minor', c12c13),
-                         7.014: iso_frac2('major', n14n15),
-                         7.015: iso_frac2('minor', n14n15)}
+        c_major = c12c13 / (c12c13 + 1.)
+        n_major = n14n15 / (n14n15 + 1.)
+
+        self.isotopes = {6.012: c_major,
+                         6.013: 1. - c_major,
+                         7.014: n_major,
+                         7.015: 1. - n_major}
 
     def set_linelists(self, linelists):
         '''
@@ -65,14 +147,15 @@ class TurboSynth:
         abund : float, new log epsilon abundance value
         '''
         if self.turbodaemon._abund_flag:
-            self.turbodaemon.abundances[au.atomic_sym_to_num(element)] = abund
+            self.turbodaemon.abundances[atomic_sym_to_num(element)] = abund
+            self._abund_key = None
 
     def get_abund(self, element):
         '''
         Retrieves a given abundance.
         '''
         if self.turbodaemon._abund_flag:
-            return self.turbodaemon.abundances[au.atomic_sym_to_num(element)]
+            return self.turbodaemon.abundances[atomic_sym_to_num(element)]
         else:
             return
 
@@ -81,24 +164,65 @@ class TurboSynth:
         return all abundances in a dictionary
         '''
         if self.turbodaemon._abund_flag:
-            return {au.atomic_num_to_sym(
-                elem): abund for elem,
-                abund in self.turbodaemon.abundances.items()}
+            if self._sym_for_num is None:
+                self._sym_for_num = {num: au.atomic_num_to_sym(num)
+                                     for num in range(1, 93)}
+            sym_for_num = self._sym_for_num
+            abundances = self.turbodaemon.abundances
+            for elem in abundances.keys() - sym_for_num.keys():
+                sym_for_num[elem] = au.atomic_num_to_sym(elem)
+            return {sym_for_num[elem]: abund for elem,
+                    abund in abundances.items()}
         else:
             return
 
-    def make_atmosphere(self, star=None):
+    def make_atmosphere(self, star=None, cache=True):
         '''
-        Makes the atmos manager and runs the interpolator
+        Makes the atmos manager and runs the interpolator.  Atmospheres are
+            cached across instances, so the interpolation is skipped if the
+            same atmosphere was already written to this path and has not
+            been rewritten since.  The cache keeps the most recently used
+            atmospheres.
+
+        star : string, passed to the interpolator to name the atmosphere
+        cache : boolean, False to neither use nor update the cache, e.g., for
+            a scratch directory that will be removed
         '''
 
-        cwd = os.getcwd()
-        abspath = os.path.join(cwd, self.path)
+        abspath = self._abspath
+
+        if not cache:
+            atmos = AtmosManager(self.teff, self.logg, self.feh,
+                                 vmicro=self.vmicro, cfe=self.cfe,
+                                 alphafe=self.alphafe)
+            self.atmosname = atmos.interp_atmos(star=star, file_format='ts',
+                                                path=abspath)
+            return
+
+        atmos_cache = TurboSynth._atmos_cache
+        key = (round(self.teff, 1), round(self.logg, 3), round(self.feh, 3),
+               self.vmicro, self.cfe, self.alphafe, star, abspath)
+        cached = atmos_cache.get(key)
+        if cached is not None and _file_stamp(
+                os.path.join(abspath, cached[0])) == cached[1]:
+            atmos_cache.move_to_end(key)
+            self.atmosname = cached[0]
+            return
+
         atmos = AtmosManager(self.teff, self.logg, self.feh,
                              vmicro=self.vmicro, cfe=self.cfe,
                              alphafe=self.alphafe)
         self.atmosname = atmos.interp_atmos(star=star, file_format='ts',
                                             path=abspath)
+        # the interpolator may have overwritten a file cached for other
+        # parameters (e.g., one named after the star), so drop those entries
+        for cached_key in [k for k, (name, _) in atmos_cache.items()
+                           if name == self.atmosname and k[-1] == abspath]:
+            del atmos_cache[cached_key]
+        atmos_cache[key] = (self.atmosname, _file_stamp(
+            os.path.join(abspath, self.atmosname)))
+        if len(atmos_cache) > TurboSynth._cache_size:
+            atmos_cache.popitem(last=False)
 
     def set_isotope(self, iso_dict):
         '''
@@ -114,51 +238,125 @@ class TurboSynth:
         for key, frac in iso_dict.items():
             self.isotopes[key] = frac
 
+    def _make_opacity(self, wave_range, delta_lambda, cache=True):
+        '''
+        Sets the wavelength range and runs babsma, reusing the opacity file
+            from an earlier run if the atmosphere, stellar parameters,
+            wavelengths and abundances are all unchanged.  The cache is
+            shared across instances and keyed by the absolute opacity file,
+            and an entry is only reused while that file has not been
+            rewritten since babsma made it.  The cache keeps the most
+            recently used opacity files.
+
+        cache : boolean, False to always run babsma and leave the cache
+            untouched, e.g., for a scratch directory that will be removed
+        '''
+        if self.atmosname is None:
+            raise RuntimeError('Please run make_atmosphere first.')
+
+        daemon = self.turbodaemon
+        daemon.set_wave(lambda_range=wave_range, delta_lambda=delta_lambda)
+
+        if not cache:
+            self.opac_filename = daemon.run_babsma(model=self.atmosname,
+                                                   vmicro=self.vmicro)
+            return
+
+        opac_path = os.path.join(self._abspath, f'{self.atmosname}_opac')
+        key = (self.teff, self.logg, self.feh, self.cfe, self.alphafe,
+               self.vmicro, tuple(wave_range), delta_lambda, daemon.metals,
+               daemon.alphas, daemon.helium, daemon.rprocess, daemon.sprocess,
+               frozenset(daemon.abundances.items()))
+
+        opac_cache = TurboSynth._opac_cache
+        cached = opac_cache.get(opac_path)
+        if (cached is not None and cached[0] == key
+                and _file_stamp(opac_path) == cached[2]):
+            opac_cache.move_to_end(opac_path)
+            daemon.model = self.atmosname
+            self.opac_filename = cached[1]
+            return
+
+        # babsma overwrites the opacity file for this atmosphere, so drop the
+        # entry before running it in case it fails part way through
+        opac_cache.pop(opac_path, None)
+        self.opac_filename = daemon.run_babsma(model=self.atmosname,
+                                               vmicro=self.vmicro)
+        opac_cache[opac_path] = (key, self.opac_filename,
+                                 _file_stamp(opac_path))
+        if len(opac_cache) > TurboSynth._cache_size:
+            opac_cache.popitem(last=False)
+
     def synth(self, wave_range, delta_lambda=0.01, synth_fname=None,
-              verbose=False):
+              verbose=False, cache=True):
         '''
         Makes a synthetic spectrum.
 
         wave_range : len 2 list, wavelenght range to synthesize in angstroms
         delta_lambda : float, wavelength step to synthesize in angstroms
         synth_fname : string, output name for the synthesized spectrum
+        cache : boolean, False to always run babsma without using or
+            updating the opacity cache
         '''
-        self.turbodaemon.set_wave(lambda_range=wave_range,
-                                  delta_lambda=delta_lambda)
-        self.opac_filename = self.turbodaemon.run_babsma(model=self.atmosname,
-                                                         vmicro=self.vmicro)
-
-        if self.logg < 3.5:
-            sph_flag = True
-        else:
-            sph_flag = False
+        self._make_opacity(wave_range, delta_lambda, cache=cache)
 
         self.synth_fname = self.turbodaemon.run_bsyn(
-            sph_flag=sph_flag, opac_filename=self.opac_filename,
+            sph_flag=self._sph_flag, opac_filename=self.opac_filename,
             linelists=self.linelists, isotopes=self.isotopes,
             result_filename=synth_fname, verbose=verbose)
 
+        self.load_synth()
+
+        if self.binary_output:
+            self.synth_npy_fname = f'{self.synth_fname}.npy'
+            np.save(self.path / self.synth_npy_fname, self._synth_data)
+
+    def load_synth(self, synth_fname=None):
+        '''
+        Reads a synthetic spectrum into memory as self.synth_wave,
+            self.synth_flux (normalized) and self.synth_absflux (None if the
+            file has no unnormalized flux column) so it can be used and
+            convolved without reading the file again.  synth calls
+            this for the spectrum it makes.  Fluxes are stored as float32,
+            which covers the precision Turbospectrum writes; wavelengths stay
+            float64.
+
+        synth_fname : string, synthetic spectrum to read (text or .npy),
+            defaults to the most recent synthesis
+
+        returns:
+        synth_wave : array, wavelengths of the synthetic spectrum
+        synth_flux : array, normalized flux of the synthetic spectrum
+        '''
+        if synth_fname is None:
+            synth_fname = self.synth_fname
+
+        self._synth_data = read_synth(self.path / synth_fname)
+        self._synth_loaded = synth_fname
+        self.synth_wave = self._synth_data[:, 0]
+        self.synth_flux = self._synth_data[:, 1].astype(np.float32)
+        if self._synth_data.shape[1] > 2:
+            self.synth_absflux = self._synth_data[:, 2].astype(np.float32)
+        else:
+            self.synth_absflux = None
+
+        return self.synth_wave, self.synth_flux
+
     def eqwidth(self, wave_range, delta_lambda=0.01, abund_fname=None,
-                verbose=False):
+                verbose=False, cache=True):
         '''
         Makes a synthetic spectrum.
 
         wave_range : len 2 list, wavelenght range to synthesize in angstroms
         delta_lambda : float, wavelength step to synthesize in angstroms
         synth_fname : string, output name for the synthesized spectrum
+        cache : boolean, False to always run babsma without using or
+            updating the opacity cache
         '''
-        self.turbodaemon.set_wave(lambda_range=wave_range,
-                                  delta_lambda=delta_lambda)
-        self.opac_filename = self.turbodaemon.run_babsma(model=self.atmosname,
-                                                         vmicro=self.vmicro)
-
-        if self.logg < 3.5:
-            sph_flag = True
-        else:
-            sph_flag = False
+        self._make_opacity(wave_range, delta_lambda, cache=cache)
 
         self.abund_fname = self.turbodaemon.run_eqwidt(
-            sph_flag=sph_flag, opac_filename=self.opac_filename,
+            sph_flag=self._sph_flag, opac_filename=self.opac_filename,
             linelists=self.linelists, isotopes=self.isotopes,
             result_filename=abund_fname, verbose=verbose)
 
@@ -183,10 +381,171 @@ class TurboSynth:
 
         return output_name
 
+    def convol_inproc(self, profile=None, fwhm=None, vel=None,
+                      synth_fname=None, convol_fname=None):
+        '''
+        Convolves the synthetic spectrum with a chosen profile in python,
+            which avoids running faltbon.  Takes the same inputs as convol,
+            and reuses the in-memory spectrum from load_synth when it holds
+            the requested file.
 
-def iso_frac2(key, ratio):
-    if key == 'major':
-        frac = ratio / (ratio + 1.)
-    elif key == 'minor':
-        frac = 1 / (ratio + 1.)
-    return frac
+        profile : integer (1-4), indicates what broadening profile to use
+            (1=exp, 2=gauss, 3=rad-tan, 4=rot)
+        fwhm : float, convolutional broadening FWHM in miliAngstroms
+        vel : float, convolutional broadening velocity in km/s
+        synth_fname : string, input synthetic spectrum
+        convol_fname : string, output convolved spectrum
+        '''
+        if synth_fname is None:
+            synth_fname = self.synth_fname
+        data = self._synth_data if synth_fname == self._synth_loaded else None
+
+        output_name = self.convoldaemon.run_inproc(
+            synth_fname, profile=profile, fwhm=fwhm, vel=vel,
+            result=convol_fname, data=data)
+
+        return output_name
+
+    def convol_batch(self, fwhms, synth_fname=None, normed=True,
+                     max_ratio=1.2, exact=False):
+        '''
+        Convolves the synthetic spectrum with Gaussians of several FWHMs
+            using a few convolutions in total (see convolve_gaussian_batch),
+            which is useful for scanning over spectral resolution.
+
+        fwhms : list or array of floats, Gaussian FWHMs in miliAngstroms
+        synth_fname : string, input synthetic spectrum
+        normed : boolean, True to convolve the normalized flux and False for
+            the unnormalized flux
+        max_ratio : float, largest ratio between neighbouring knot FWHMs
+        exact : boolean, True to convolve with each FWHM separately
+
+        returns:
+        wave : array, the wavelengths of the spectrum
+        fluxes : 2D array, one convolved spectrum per FWHM
+        '''
+        if synth_fname is None:
+            synth_fname = self.synth_fname
+        data = self._synth_data if synth_fname == self._synth_loaded else None
+
+        return self.convoldaemon.run_batch(synth_fname, fwhms, normed=normed,
+                                           data=data, max_ratio=max_ratio,
+                                           exact=exact)
+
+
+def synthesize_one(params):
+    '''
+    Runs the full TurboSynth pipeline for one set of stellar parameters in
+        its own scratch directory, which is removed afterwards.  Since it
+        takes a single picklable argument and shares no files with other
+        calls, grids can be run in parallel, e.g.,
+
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            spectra = list(pool.map(synthesize_one, param_list))
+
+    params : dictionary with the keys
+        teff, logg, feh : floats, stellar parameters
+        wave_range : len 2 list, wavelength range to synthesize in angstroms
+        linelists : list, paths to the input linelists
+        and optionally
+        turbopath : string, the path to Turbospectrum (default '.')
+        vmicro, cfe, alphafe : floats, passed to init_params
+        abunds : dictionary, passed to init_abunds
+        solar_reference : string, passed to init_abunds
+        isotopes : dictionary, passed to set_isotope
+        star : string, passed to make_atmosphere
+        delta_lambda : float, wavelength step in angstroms (default 0.01)
+
+    returns:
+    wave : array, wavelengths of the synthetic spectrum
+    flux : array, normalized flux of the synthetic spectrum
+    absflux : array, unnormalized flux of the synthetic spectrum
+    '''
+    with tempfile.TemporaryDirectory() as workdir:
+        turbosynth = TurboSynth(path=workdir,
+                                turbopath=params.get('turbopath', '.'))
+        turbosynth.init_params(params['teff'], params['logg'], params['feh'],
+                               vmicro=params.get('vmicro'),
+                               cfe=params.get('cfe', 0.0),
+                               alphafe=params.get('alphafe', 0.0))
+        turbosynth.init_abunds(
+            abunds=params.get('abunds'),
+            solar_reference=params.get('solar_reference', 'Asplund2009'))
+        if params.get('isotopes'):
+            turbosynth.set_isotope(params['isotopes'])
+        turbosynth.set_linelists(params['linelists'])
+        turbosynth.make_atmosphere(star=params.get('star'), cache=False)
+        turbosynth.synth(params['wave_range'],
+                         delta_lambda=params.get('delta_lambda', 0.01),
+                         cache=False)
+
+        return (turbosynth.synth_wave, turbosynth.synth_flux,
+                turbosynth.synth_absflux)
+
+
+def run_pipeline(star_iter, convol_kwargs, maxsize=2):
+    '''
+    Synthesizes and convolves a sequence of stars, running the synthesis of
+        the next star in a background thread while the current one is
+        convolved.  The synthesis spends its time waiting on Turbospectrum
+        and the convolution in numpy/scipy, so the two overlap.  At most
+        maxsize synthesized spectra wait to be convolved.
+
+    star_iter : iterable of dictionaries, parameters for each star in the
+        format taken by synthesize_one
+    convol_kwargs : dictionary or list of dictionaries, the profile, fwhm
+        and/or vel for convolve_spectrum, applied in order, e.g.,
+        [{'profile': 2, 'fwhm': 43.0}, {'profile': 4, 'vel': 3.8}]
+    maxsize : integer, number of synthesized spectra to buffer
+
+    yields:
+    wave : array, wavelengths of the synthetic spectrum
+    flux : array, convolved normalized flux of the synthetic spectrum
+    '''
+    if isinstance(convol_kwargs, dict):
+        convol_kwargs = [convol_kwargs]
+
+    synthesized = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # gives up once the consumer has stopped so the thread can exit
+        while not stop.is_set():
+            try:
+                synthesized.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for params in star_iter:
+                if stop.is_set():
+                    return
+                wave, flux, _ = synthesize_one(params)
+                if not put((wave, flux)):
+                    return
+        except Exception as error:
+            put(error)
+            return
+        put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item = synthesized.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+
+            wave, flux = item
+            for kwargs in convol_kwargs:
+                flux = convolve_spectrum(wave, flux, **kwargs)
+            yield wave, flux
+    finally:
+        # runs when the generator finishes, raises or is closed early
+        stop.set()